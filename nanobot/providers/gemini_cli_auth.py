@@ -1,8 +1,29 @@
+import asyncio
+import atexit
+import base64
+import functools
+import json
 import os
+import random
 import re
 import shutil
+import threading
+import time
+from collections.abc import Callable, Generator
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, TypeVar
+
 import httpx
+from loguru import logger
+
+from nanobot.utils.helpers import get_data_path
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # These credentials belong to the Google Gemini CLI (Cloud AI Companion).
 # They are for a Desktop/Installed application and are not treated as secrets.
@@ -11,11 +32,107 @@ import httpx
 # See: https://developers.google.com/identity/protocols/oauth2#installed
 
 TOKEN_URL = "https://oauth2.googleapis.com/token"
+CODE_ASSIST_ENDPOINT = "https://cloudcode-pa.googleapis.com"
 
-def extract_credentials() -> tuple[str, str]:
+# OpenClaw default project - a good fallback if the user-provisioned one is broken
+DEFAULT_PROJECT_ID = "rising-fact-p41fc"
+
+# Onboarding LRO poll schedule: exponential backoff with jitter, bounded overall
+ONBOARD_POLL_TIMEOUT = 120.0
+ONBOARD_POLL_INITIAL_DELAY = 0.25
+ONBOARD_POLL_MAX_DELAY = 5.0
+
+# Server-side LRO wait (operations :wait), tried before falling back to polling.
+# Each attempt blocks server-side for up to ONBOARD_WAIT_TIMEOUT seconds, never
+# past the ONBOARD_POLL_TIMEOUT deadline.
+ONBOARD_WAIT_ATTEMPTS = 4
+ONBOARD_WAIT_TIMEOUT = 30.0
+
+_CLIENT_METADATA = {
+    "ideType": "IDE_UNSPECIFIED",
+    "platform": "PLATFORM_UNSPECIFIED",
+    "pluginType": "GEMINI",
+}
+
+# Google Antigravity (Cloud Code Assist) client, decoded from openclaw source to stay in sync
+_ANTIGRAV_CID = base64.b64decode(
+    "MTA3MTAwNjA2MDU5MS10bWhzc2luMmgyMWxjcmUyMzV2dG9sb2poNGc0MDNlcC5hcHBzLmdvb2dsZXVzZXJjb250ZW50LmNvbQ=="
+).decode("ascii")
+_ANTIGRAV_SEC = base64.b64decode("R09DU1BYLUs1OEZXUjQ4NkxkTEoxbUxCOHNYQzR6NnFEQWY=").decode("ascii")
+
+# Client ID and secret in one alternation so the bundle is scanned only once
+_CREDENTIALS_RE = re.compile(
+    rb"(?P<cid>\d+-[a-z0-9]+\.apps\.googleusercontent\.com)|(?P<sec>GOCSPX-[A-Za-z0-9_-]+)"
+)
+
+# Shared client so the token, loadCodeAssist/onboardUser and serviceusage calls
+# reuse pooled keep-alive connections instead of a fresh TLS handshake each time.
+# HTTP/2 is left off: it needs the optional `h2` package (httpx[http2]).
+# The async client serves the agent's event loop the same way; it is left for
+# interpreter shutdown to close since aclose() needs a running loop.
+_CLIENT_OPTIONS = dict(
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60),
+    headers={
+        "User-Agent": "google-api-nodejs-client/9.15.1",
+        "X-Goog-Api-Client": "gl-node/openclaw",
+    },
+)
+_CLIENT = httpx.Client(**_CLIENT_OPTIONS)
+atexit.register(_CLIENT.close)
+_ASYNC_CLIENT = httpx.AsyncClient(**_CLIENT_OPTIONS)
+
+# refresh_token -> (access_token, project_id, expires_at). Access tokens live for
+# about an hour, so repeated refreshes can skip the token exchange and project
+# discovery entirely until shortly before expiry.
+_TOKEN_CACHE: dict[str, tuple[str, str | None, float]] = {}
+# refresh_token -> project ID that discovery actually resolved. Kept apart from
+# the token cache so a fallback (e.g. DEFAULT_PROJECT_ID after a transient
+# error) is never reused and discovery is retried on the next token exchange.
+_DISCOVERED_PROJECTS: dict[str, str] = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+_TOKEN_EXPIRY_MARGIN = 60.0
+
+def _enabled_projects_path() -> Path:
+    return get_data_path() / "enabled_projects.json"
+
+def _load_enabled_projects() -> set[str]:
+    try:
+        return set(json.loads(_enabled_projects_path().read_text(encoding="utf-8")))
+    except (OSError, ValueError, TypeError):
+        return set()
+
+# Projects the Vertex AI API is known to be enabled on, persisted across restarts.
+# Loaded on first use so importing this module has no filesystem side effects.
+_ENABLED_PROJECTS: set[str] | None = None
+_ENABLED_PROJECTS_LOCK = threading.Lock()
+
+def _enabled_projects() -> set[str]:
+    """The enabled-project set, loading it if needed. Call with the lock held."""
+    global _ENABLED_PROJECTS
+    if _ENABLED_PROJECTS is None:
+        _ENABLED_PROJECTS = _load_enabled_projects()
+    return _ENABLED_PROJECTS
+
+def _is_enabled(project_id: str) -> bool:
+    with _ENABLED_PROJECTS_LOCK:
+        return project_id in _enabled_projects()
+
+def _mark_enabled(project_id: str) -> None:
+    with _ENABLED_PROJECTS_LOCK:
+        projects = _enabled_projects()
+        projects.add(project_id)
+        try:
+            _enabled_projects_path().write_text(json.dumps(sorted(projects)), encoding="utf-8")
+        except OSError as e:
+            logger.warning("Could not persist enabled projects: {}", e)
+
+@functools.lru_cache(maxsize=1)
+def _oauth2_js_candidates() -> tuple[Path, ...]:
     """
-    Attempt to extract Gemini CLI OAuth credentials from the locally installed package.
-    Throws RuntimeError if extraction fails or CLI is not found.
+    Candidate paths of the Gemini CLI's bundled oauth2.js.
+    Raises RuntimeError if the CLI is not in PATH; lru_cache doesn't cache the
+    exception, so a CLI installed later is still picked up.
     """
     gemini_path = shutil.which("gemini")
     if not gemini_path:
@@ -26,27 +143,39 @@ def extract_credentials() -> tuple[str, str]:
 
     # Resolve symlinks to find the actual installation directory
     resolved_path = Path(gemini_path).resolve()
-    
-    # Search for oauth2.js in common locations relative to the executable
-    search_roots = [
-        resolved_path.parents[1], # .../node_modules/@google/gemini-cli
-        resolved_path.parents[2], # .../node_modules/@google
-    ]
-    
-    for root in search_roots:
-        # We look for the file in the nested node_modules of the core package
-        potential_file = root / "node_modules" / "@google" / "gemini-cli-core" / "dist" / "src" / "code_assist" / "oauth2.js"
-        if potential_file.exists():
-            content = potential_file.read_text(encoding="utf-8")
-            
-            id_match = re.search(r"(\d+-[a-z0-9]+\.apps\.googleusercontent\.com)", content)
-            secret_match = re.search(r"(GOCSPX-[A-Za-z0-9_-]+)", content)
-            
-            if id_match and secret_match:
-                cid = id_match.group(1)
-                print(f"[DEBUG] Extracted Gemini CLI Client ID: {cid[:4]}...***")
-                return cid, secret_match.group(1)
-                
+
+    # oauth2.js lives in the nested node_modules of the core package, relative to
+    # .../node_modules/@google/gemini-cli or .../node_modules/@google
+    return tuple(
+        root / "node_modules" / "@google" / "gemini-cli-core" / "dist" / "src" / "code_assist" / "oauth2.js"
+        for root in (resolved_path.parents[1], resolved_path.parents[2])
+    )
+
+@functools.lru_cache(maxsize=1)
+def extract_credentials() -> tuple[str, str]:
+    """
+    Attempt to extract Gemini CLI OAuth credentials from the locally installed package.
+    Throws RuntimeError if extraction fails or CLI is not found.
+    """
+    for potential_file in _oauth2_js_candidates():
+        # Read directly rather than exists() + read; the bundle is ASCII, so
+        # scan the raw bytes and only decode the matches
+        try:
+            content = potential_file.read_bytes()
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+        cid = sec = None
+        for m in _CREDENTIALS_RE.finditer(content):
+            if m.lastgroup == "cid":
+                cid = cid or m.group("cid")
+            else:
+                sec = sec or m.group("sec")
+            if cid and sec:
+                cid_str = cid.decode("ascii")
+                logger.debug("Extracted Gemini CLI Client ID: {}...***", cid_str[:4])
+                return cid_str, sec.decode("ascii")
+
     raise RuntimeError(
         "Could not find Gemini CLI credentials. Please install the CLI: npm install -g @google/gemini-cli"
     )
@@ -56,203 +185,414 @@ def extract_antigravity_credentials() -> tuple[str, str]:
     Returns hardcoded Client ID/Secret for Google Antigravity (Cloud Code Assist).
     These are public constants used in VS Code extensions / OpenClaw.
     """
-    import base64
-    # Decoded from openclaw source to stay in sync
-    # CLIENT_ID = decode("MTA3...=")
-    # CLIENT_SECRET = decode("R09D...=")
-    
-    # We can just return them directly or base64 decode them to be safe/obfuscated similarly
-    cid_b64 = "MTA3MTAwNjA2MDU5MS10bWhzc2luMmgyMWxjcmUyMzV2dG9sb2poNGc0MDNlcC5hcHBzLmdvb2dsZXVzZXJjb250ZW50LmNvbQ=="
-    sec_b64 = "R09DU1BYLUs1OEZXUjQ4NkxkTEoxbUxCOHNYQzR6NnFEQWY="
-    
-    cid = base64.b64decode(cid_b64).decode("utf-8")
-    sec = base64.b64decode(sec_b64).decode("utf-8")
-    
-    print(f"[DEBUG] Using Google Antigravity Client ID: {cid[:4]}...***")
-    return cid, sec
-
-CODE_ASSIST_ENDPOINT = "https://cloudcode-pa.googleapis.com"
+    return _ANTIGRAV_CID, _ANTIGRAV_SEC
 
-def discover_project(access_token: str) -> str | None:
+def reset() -> None:
     """
-    Discover the Google Cloud project ID associated with the account.
-    This is a near-exact port of openclaw's discoverProject logic.
+    Clear cached credentials, tokens and projects (mainly for tests).
+    The enabled-project set is reloaded from disk on next use.
     """
-    env_project = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT_ID")
-    masked_env = f"{env_project[:4]}...***" if env_project else "None"
-    print(f"[DEBUG] Starting project discovery (Env Project: {masked_env})")
-    headers = {
+    global _ENABLED_PROJECTS
+    _oauth2_js_candidates.cache_clear()
+    extract_credentials.cache_clear()
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.clear()
+        _DISCOVERED_PROJECTS.clear()
+    with _ENABLED_PROJECTS_LOCK:
+        _ENABLED_PROJECTS = None
+
+# --- Request building / response handling ---
+
+def _json_body(obj: dict) -> bytes:
+    """Encode a request body, using orjson when it is installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def _json(resp: httpx.Response) -> dict:
+    """Decode a response body, using orjson when it is installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(resp.content)
+    return json.loads(resp.content)
+
+def _env_project() -> str | None:
+    return os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GOOGLE_CLOUD_PROJECT_ID")
+
+def _should_trust_env_project(env_project: str | None) -> bool:
+    """Whether a configured project should be used as-is, skipping discovery."""
+    return bool(env_project) and os.environ.get("NANOBOT_TRUST_ENV_PROJECT", "1") == "1"
+
+def _code_assist_headers(access_token: str) -> dict[str, str]:
+    return {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
-        "User-Agent": "google-api-nodejs-client/9.15.1",
-        "X-Goog-Api-Client": "gl-node/openclaw",
     }
-    
-    # 1. Attempt loadCodeAssist
-    try:
-        load_body = {
-            "cloudaicompanionProject": env_project,
-            "metadata": {
-                "ideType": "IDE_UNSPECIFIED",
-                "platform": "PLATFORM_UNSPECIFIED",
-                "pluginType": "GEMINI",
-                "duetProject": env_project,
-            }
-        }
-        resp = httpx.post(f"{CODE_ASSIST_ENDPOINT}/v1internal:loadCodeAssist", headers=headers, json=load_body, timeout=10.0)
-        
-        # OpenClaw logic: if status is OK, parse. If VPC-SC error, assume standard tier. Else fail.
-        data = {}
-        if resp.status_code == 200:
-            data = resp.json()
-            print(f"[DEBUG] loadCodeAssist success: {list(data.keys())}")
-        else:
-             print(f"[DEBUG] loadCodeAssist failed: {resp.status_code}")
-             # OpenClaw has logic for isVpcScAffected -> TIER_STANDARD
-             # We'll skip for now unless we see it.
-    
-        # OpenClaw Logic: 
-        # if (data.currentTier) { 
-        #   const project = data.cloudaicompanionProject;
-        #   if (typeof project === "string") return project;
-        #   if (typeof project === "object" && project.id) return project.id;
-        #   if (envProject) return envProject;
-        #   throw Error...
-        # }
-        
-        if data.get("currentTier"):
-            proj = data.get("cloudaicompanionProject")
-            final_pid = None
-            if isinstance(proj, str) and proj: final_pid = proj
-            elif isinstance(proj, dict) and proj.get("id"): final_pid = proj["id"]
-            elif env_project: final_pid = env_project
-            
-            if final_pid:
-                print(f"[DEBUG] Resolved project from loadCodeAssist: {final_pid[:4]}...***")
-                return final_pid
-            else:
-                 print("[DEBUG] loadCodeAssist returned currentTier but no project ID found.")
-                 # OpenClaw throws error here.
-
-        # If we are here, OpenClaw proceeds to Onboarding.
-        # const tier = getDefaultTier(data.allowedTiers);
-        allowed = data.get("allowedTiers", [])
-        tier = next((t for t in allowed if t.get("isDefault")), None) or {"id": "legacy-tier"} # OpenClaw defaults to legacy-tier if empty
-        tier_id = tier.get("id") or "free-tier"
-        
-        # openclaw: if (tierId !== TIER_FREE && !envProject) throw Error...
-        
-        onboard_body = {
-            "tierId": tier_id,
-            "metadata": {
-                "ideType": "IDE_UNSPECIFIED",
-                "platform": "PLATFORM_UNSPECIFIED",
-                "pluginType": "GEMINI",
-            }
-        }
-        if tier_id != "free-tier" and env_project:
-            onboard_body["cloudaicompanionProject"] = env_project
-            onboard_body["metadata"]["duetProject"] = env_project # type: ignore
-
-        print(f"[DEBUG] Onboarding user with tier: {tier_id}")
-        onboard_resp = httpx.post(f"{CODE_ASSIST_ENDPOINT}/v1internal:onboardUser", headers=headers, json=onboard_body, timeout=15.0)
-        onboard_resp.raise_for_status()
-        lro = onboard_resp.json()
-        
-        # OpenClaw polling logic
-        import time
-        for _ in range(24): # OpenClaw polls 24 times * 5s
-            if lro.get("done"): break
-            if not lro.get("name"): break
-            
-            # OpenClaw waits 5000ms BEFORE fetching
-            time.sleep(5) 
-            poll_resp = httpx.get(f"{CODE_ASSIST_ENDPOINT}/v1internal/{lro['name']}", headers=headers, timeout=10.0)
-            if poll_resp.status_code == 200:
-                lro = poll_resp.json()
-        
-        pid = lro.get("response", {}).get("cloudaicompanionProject", {}).get("id")
-        final_pid = pid or env_project
-        if final_pid:
-            print(f"[DEBUG] Resolved project from Onboarding: {final_pid[:4]}...***")
-            return final_pid
-            
-        print("[DEBUG] Failed to resolve project after onboarding.")
-        return env_project
 
-    except Exception as e:
-        print(f"[DEBUG] Discovery error: {e}")
-        return env_project
+def _load_code_assist_body(env_project: str | None) -> dict:
+    return {
+        "cloudaicompanionProject": env_project,
+        "metadata": {**_CLIENT_METADATA, "duetProject": env_project},
+    }
 
-def enable_vertex_api(project_id: str, access_token: str) -> None:
-    """Enable the Vertex AI API for the project."""
-    url = f"https://serviceusage.googleapis.com/v1/projects/{project_id}/services/aiplatform.googleapis.com:enable"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    try:
-        # Check if already enabled? serviceusage.services.get
-        # Simple approach: just try to enable it. match openclaw behavior.
-        masked_pid = f"{project_id[:4]}...***"
-        print(f"[DEBUG] Ensuring Vertex AI API is enabled for {masked_pid}...")
-        resp = httpx.post(url, headers=headers, timeout=10.0)
-        if resp.status_code == 200:
-            lro = resp.json()
-            if lro.get("done"):
-                print(f"[DEBUG] Vertex AI API already enabled or operation complete.")
-            else:
-                print(f"[DEBUG] Enabling Vertex AI API (LRO: {lro.get('name')})...")
-                # We could poll, but usually it's fast enough or we can proceed and let it finish
-                # But to be safe, let's wait a few seconds
-                import time
-                time.sleep(3)
-        elif resp.status_code == 403:
-             print(f"[DEBUG] Permission denied enabling API. User might not have 'serviceusage.services.enable'.")
-        else:
-             print(f"[DEBUG] Enable API request failed: {resp.status_code} {resp.text}")
-    except Exception as e:
-        print(f"[DEBUG] Failed to enable Vertex AI API: {e}")
+def _parse_load_code_assist(resp: httpx.Response) -> dict:
+    # OpenClaw logic: if status is OK, parse. If VPC-SC error, assume standard tier. Else fail.
+    if resp.status_code == 200:
+        data = _json(resp)
+        logger.debug("loadCodeAssist success: {}", list(data))
+        return data
+    logger.debug("loadCodeAssist failed: {}", resp.status_code)
+    # OpenClaw has logic for isVpcScAffected -> TIER_STANDARD
+    # We'll skip for now unless we see it.
+    return {}
 
-def refresh_access_token(refresh_token: str) -> tuple[str, str | None]:
-    """
-    Refresh the Google OAuth access token and discover the project ID.
-    Returns (access_token, project_id).
-    """
+def _has_current_tier(data: dict) -> bool:
+    """Whether loadCodeAssist reports the account as already provisioned."""
+    return data.get("currentTier") is not None
+
+def _project_from_load_code_assist(data: dict, env_project: str | None) -> str | None:
+    """Resolve the project for a provisioned account (see _has_current_tier)."""
+    # OpenClaw Logic:
+    # if (data.currentTier) {
+    #   const project = data.cloudaicompanionProject;
+    #   if (typeof project === "string") return project;
+    #   if (typeof project === "object" && project.id) return project.id;
+    #   if (envProject) return envProject;
+    #   throw Error...
+    # }
+    match data.get("cloudaicompanionProject"):
+        case str(pid) if pid:
+            final_pid = pid
+        case {"id": pid} if pid:
+            final_pid = pid
+        case _:
+            final_pid = env_project
+
+    if final_pid:
+        logger.debug("Resolved project from loadCodeAssist: {}...***", final_pid[:4])
+        return final_pid
+    # OpenClaw throws here; we let the caller fall back to the default project.
+    logger.warning("loadCodeAssist returned currentTier but no project ID found.")
+    return None
+
+def _onboard_body(data: dict, env_project: str | None) -> dict:
+    # No currentTier: OpenClaw proceeds to Onboarding.
+    # const tier = getDefaultTier(data.allowedTiers);
+    allowed = data.get("allowedTiers", [])
+    tier = next((t for t in allowed if t.get("isDefault")), None) or {"id": "legacy-tier"} # OpenClaw defaults to legacy-tier if empty
+    tier_id = tier.get("id") or "free-tier"
+
+    # openclaw: if (tierId !== TIER_FREE && !envProject) throw Error...
+
+    onboard_body = {"tierId": tier_id, "metadata": dict(_CLIENT_METADATA)}
+    if tier_id != "free-tier" and env_project:
+        onboard_body["cloudaicompanionProject"] = env_project
+        onboard_body["metadata"]["duetProject"] = env_project # type: ignore
+
+    logger.debug("Onboarding user with tier: {}", tier_id)
+    return onboard_body
+
+def _poll_delays():
+    """Yield jittered, exponentially growing sleeps for the onboarding poll loop."""
+    delay = ONBOARD_POLL_INITIAL_DELAY
+    while True:
+        yield delay + random.uniform(0, delay * 0.25)
+        delay = min(delay * 2, ONBOARD_POLL_MAX_DELAY)
+
+def _project_from_onboarding(lro: dict, env_project: str | None) -> str | None:
+    pid = lro.get("response", {}).get("cloudaicompanionProject", {}).get("id")
+    final_pid = pid or env_project
+    if final_pid:
+        logger.debug("Resolved project from Onboarding: {}...***", final_pid[:4])
+        return final_pid
+
+    logger.warning("Failed to resolve project after onboarding.")
+    return env_project
+
+def _vertex_enable_url(project_id: str) -> str:
+    return f"https://serviceusage.googleapis.com/v1/projects/{project_id}/services/aiplatform.googleapis.com:enable"
+
+def _handle_enable_response(resp: httpx.Response) -> bool:
+    """Log the enable result; return whether the API is known to be enabled."""
+    if resp.status_code == 200:
+        lro = _json(resp)
+        if lro.get("done"):
+            logger.debug("Vertex AI API already enabled or operation complete.")
+            return True
+        # Don't wait for the operation; if enablement is still pending the
+        # next API call will surface it, and we retry on the next refresh.
+        logger.debug("Enabling Vertex AI API (LRO: {})...", lro.get("name"))
+    elif resp.status_code == 403:
+        logger.warning("Permission denied enabling API. User might not have 'serviceusage.services.enable'.")
+    else:
+        logger.warning("Enable API request failed: {} {}", resp.status_code, resp.text)
+    return False
+
+def _cached_token(refresh_token: str) -> tuple[str, str | None, float] | None:
     if not refresh_token:
         raise ValueError("Refresh token is required")
+    with _TOKEN_CACHE_LOCK:
+        return _TOKEN_CACHE.get(refresh_token)
+
+def _token_is_fresh(entry: tuple[str, str | None, float] | None) -> bool:
+    return bool(entry) and entry[2] - time.time() > _TOKEN_EXPIRY_MARGIN
 
+def _token_request_data(refresh_token: str) -> dict[str, str]:
     # Try Antigravity credentials first, then Gemini CLI
     try:
         client_id, client_secret = extract_antigravity_credentials()
     except Exception:
         client_id, client_secret = extract_credentials()
 
-    data = {
+    return {
         "client_id": client_id,
         "client_secret": client_secret,
         "refresh_token": refresh_token,
         "grant_type": "refresh_token",
     }
 
-    response = httpx.post(TOKEN_URL, data=data)
+def _parse_token_response(response: httpx.Response) -> tuple[str, float]:
+    """Return (access_token, expires_at) from a token endpoint response."""
     response.raise_for_status()
-    
-    tokens = response.json()
+    tokens = _json(response)
     access_token = tokens.get("access_token")
     if not access_token:
         raise ValueError("Failed to obtain access token from response")
-        
-    project_id = discover_project(access_token)
-    
-    # OpenClaw default project - a good fallback if the user-provisioned one is broken
-    DEFAULT_PROJECT_ID = "rising-fact-p41fc" 
-    
-    if project_id:
+    return access_token, time.time() + float(tokens.get("expires_in") or 3600)
+
+def _store_token(refresh_token: str, access_token: str, project_id: str | None, expires_at: float) -> None:
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[refresh_token] = (access_token, project_id, expires_at)
+
+# --- Flows: the discovery/enable/refresh logic written once, without I/O. Each
+# flow yields _Request/_Sleep/_Blocking steps and receives the result back; the
+# sync and async drivers below perform them. Any exception raised performing a
+# step is thrown into the flow at the yield that issued it, so the flows' own
+# handlers decide the fallback; only BaseException (e.g. cancellation) escapes.
+
+@dataclass(frozen=True)
+class _Request:
+    """An HTTP request for a flow driver to perform."""
+
+    method: str
+    url: str
+    headers: dict[str, str] | None = None
+    content: bytes | None = None
+    data: dict[str, str] | None = None
+    timeout: float = 10.0
+
+
+@dataclass(frozen=True)
+class _Sleep:
+    """A pause for a flow driver to perform."""
+
+    seconds: float
+
+
+@dataclass(frozen=True)
+class _Blocking:
+    """A blocking call (e.g. file I/O); the async driver runs it in a worker thread."""
+
+    fn: Callable[..., Any]
+    args: tuple = ()
+
+
+T = TypeVar("T")
+Flow = Generator[_Request | _Sleep | _Blocking, Any, T]
+
+def _resolve_project_flow(access_token: str) -> Flow[str | None]:
+    """Discovery proper; errors propagate so callers can tell them from a result."""
+    env_project = _env_project()
+    # An explicitly configured project is trusted as-is unless opted out
+    if _should_trust_env_project(env_project):
+        logger.debug("Using project from environment: {}...***", env_project[:4])
+        return env_project
+    logger.debug("Starting project discovery (env project set: {})", bool(env_project))
+    headers = _code_assist_headers(access_token)
+
+    # 1. Attempt loadCodeAssist
+    resp = yield _Request("POST", f"{CODE_ASSIST_ENDPOINT}/v1internal:loadCodeAssist", headers, _json_body(_load_code_assist_body(env_project)))
+    data = _parse_load_code_assist(resp)
+    # An account with a currentTier is already provisioned, so re-onboarding
+    # won't produce a project; only onboard when there is no tier at all.
+    # This matches OpenClaw, which never onboards once currentTier is set.
+    if _has_current_tier(data):
+        return _project_from_load_code_assist(data, env_project)
+
+    # 2. Onboard, then wait on the LRO server-side. If :wait isn't supported,
+    # poll instead; the first poll is immediate since onboarding is often
+    # done by the time the POST returns.
+    onboard_resp = yield _Request("POST", f"{CODE_ASSIST_ENDPOINT}/v1internal:onboardUser", headers, _json_body(_onboard_body(data, env_project)), timeout=15.0)
+    onboard_resp.raise_for_status()
+    lro = _json(onboard_resp)
+
+    deadline = time.monotonic() + ONBOARD_POLL_TIMEOUT
+    for _ in range(ONBOARD_WAIT_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if lro.get("done") or not lro.get("name") or remaining <= 0:
+            break
+        # Neither the server-side wait nor the client timeout may outlast the deadline
+        wait = min(ONBOARD_WAIT_TIMEOUT, remaining)
+        # :wait is speculative: any failure (unsupported, throttled, server or
+        # transport error) drops straight to polling rather than retrying it
         try:
-            enable_vertex_api(project_id, access_token)
-        except Exception:
-            print(f"[DEBUG] Failed to enable/verify API on {project_id}. Falling back to default.")
-            project_id = DEFAULT_PROJECT_ID
+            wait_resp = yield _Request("POST", f"{CODE_ASSIST_ENDPOINT}/v1internal/{lro['name']}:wait", headers, _json_body({"timeout": f"{wait:.3f}s"}), timeout=min(wait + 5.0, remaining))
+        except httpx.HTTPError as e:
+            logger.debug("LRO wait failed ({}), falling back to polling.", e)
+            break
+        if wait_resp.status_code != 200:
+            logger.debug("LRO wait returned {}, falling back to polling.", wait_resp.status_code)
+            break
+        lro = _json(wait_resp)
+
+    delays = _poll_delays()
+    while not lro.get("done") and lro.get("name"):
+        poll_resp = yield _Request("GET", f"{CODE_ASSIST_ENDPOINT}/v1internal/{lro['name']}", headers)
+        if poll_resp.status_code == 200:
+            lro = _json(poll_resp)
+        if lro.get("done"):
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Never sleep past the deadline; a clamped last sleep is followed by
+        # one final poll at the deadline rather than ending the loop unchecked
+        yield _Sleep(min(next(delays), remaining))
+
+    return _project_from_onboarding(lro, env_project)
+
+def _discover_flow(access_token: str) -> Flow[str | None]:
+    try:
+        return (yield from _resolve_project_flow(access_token))
+    except Exception as e:
+        logger.warning("Project discovery error: {}", e)
+        return _env_project()
+
+def _enable_flow(project_id: str, access_token: str) -> Flow[None]:
+    # The enabled-project set is backed by a file, so it's read and written
+    # through _Blocking steps to keep that I/O off the event loop
+    if (yield _Blocking(_is_enabled, (project_id,))):
+        return
+    try:
+        # Check if already enabled? serviceusage.services.get
+        # Simple approach: just try to enable it. match openclaw behavior.
+        logger.debug("Ensuring Vertex AI API is enabled for {}...***", project_id[:4])
+        resp = yield _Request("POST", _vertex_enable_url(project_id), {"Authorization": f"Bearer {access_token}"})
+        if _handle_enable_response(resp):
+            yield _Blocking(_mark_enabled, (project_id,))
+    except Exception as e:
+        logger.warning("Failed to enable Vertex AI API: {}", e)
+
+def _refresh_flow(refresh_token: str) -> Flow[tuple[str, str | None]]:
+    entry = _cached_token(refresh_token)
+    if _token_is_fresh(entry):
+        return entry[0], entry[1]
+
+    response = yield _Request("POST", TOKEN_URL, data=_token_request_data(refresh_token))
+    access_token, expires_at = _parse_token_response(response)
+
+    # Reuse the project discovered for this refresh token on earlier refreshes
+    with _TOKEN_CACHE_LOCK:
+        project_id = _DISCOVERED_PROJECTS.get(refresh_token)
+    if project_id is None:
+        try:
+            project_id = yield from _resolve_project_flow(access_token)
+        except Exception as e:
+            logger.warning("Project discovery error: {}", e)
+            project_id = _env_project()
+        else:
+            if project_id:
+                with _TOKEN_CACHE_LOCK:
+                    _DISCOVERED_PROJECTS[refresh_token] = project_id
+
+    # _enable_flow logs and swallows its own failures, as the baseline's
+    # enable_vertex_api did, so a discovered project is never swapped out here
+    if project_id:
+        yield from _enable_flow(project_id, access_token)
     else:
-        print(f"[DEBUG] No project discovered. Using default: {DEFAULT_PROJECT_ID}")
+        logger.debug("No project discovered. Using default: {}", DEFAULT_PROJECT_ID)
         project_id = DEFAULT_PROJECT_ID
-        
+
+    _store_token(refresh_token, access_token, project_id, expires_at)
     return access_token, project_id
+
+def _perform(step: _Request | _Sleep | _Blocking) -> Any:
+    if isinstance(step, _Sleep):
+        time.sleep(step.seconds)
+        return None
+    if isinstance(step, _Blocking):
+        return step.fn(*step.args)
+    return _CLIENT.request(step.method, step.url, headers=step.headers, content=step.content, data=step.data, timeout=step.timeout)
+
+async def _perform_async(step: _Request | _Sleep | _Blocking) -> Any:
+    if isinstance(step, _Sleep):
+        await asyncio.sleep(step.seconds)
+        return None
+    if isinstance(step, _Blocking):
+        return await asyncio.to_thread(step.fn, *step.args)
+    return await _ASYNC_CLIENT.request(step.method, step.url, headers=step.headers, content=step.content, data=step.data, timeout=step.timeout)
+
+def _run(flow: Flow[T]) -> T:
+    """Drive a flow to completion with the shared sync client."""
+    try:
+        step = next(flow)
+        while True:
+            try:
+                result = _perform(step)
+            except Exception as e:
+                step = flow.throw(e)
+            else:
+                step = flow.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+async def _run_async(flow: Flow[T]) -> T:
+    """Drive a flow to completion with the shared async client."""
+    try:
+        step = next(flow)
+        while True:
+            try:
+                result = await _perform_async(step)
+            except Exception as e:
+                step = flow.throw(e)
+            else:
+                step = flow.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+# --- Sync API ---
+
+def discover_project(access_token: str) -> str | None:
+    """
+    Discover the Google Cloud project ID associated with the account.
+    This is a near-exact port of openclaw's discoverProject logic.
+    """
+    return _run(_discover_flow(access_token))
+
+def enable_vertex_api(project_id: str, access_token: str) -> None:
+    """Enable the Vertex AI API for the project."""
+    _run(_enable_flow(project_id, access_token))
+
+def refresh_access_token(refresh_token: str) -> tuple[str, str | None]:
+    """
+    Refresh the Google OAuth access token and discover the project ID.
+    Returns (access_token, project_id).
+    """
+    return _run(_refresh_flow(refresh_token))
+
+# --- Async API, used from the agent's event loop so refreshes don't block it ---
+
+async def discover_project_async(access_token: str) -> str | None:
+    """Async counterpart of discover_project()."""
+    return await _run_async(_discover_flow(access_token))
+
+async def enable_vertex_api_async(project_id: str, access_token: str) -> None:
+    """Async counterpart of enable_vertex_api()."""
+    await _run_async(_enable_flow(project_id, access_token))
+
+async def refresh_access_token_async(refresh_token: str) -> tuple[str, str | None]:
+    """
+    Async counterpart of refresh_access_token() that does not block the event loop.
+    Returns (access_token, project_id).
+    """
+    return await _run_async(_refresh_flow(refresh_token))
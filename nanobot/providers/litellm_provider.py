@@ -9,7 +9,7 @@ from litellm import acompletion
 
 from nanobot.providers.base import LLMProvider, LLMResponse, ToolCallRequest
 from nanobot.providers.registry import find_by_model, find_gateway
-from nanobot.providers.gemini_cli_auth import refresh_access_token
+from nanobot.providers.gemini_cli_auth import refresh_access_token_async
 
 
 class LiteLLMProvider(LLMProvider):
@@ -50,16 +50,16 @@ class LiteLLMProvider(LLMProvider):
         # Disable LiteLLM logging noise
         litellm.suppress_debug_info = True
 
-    def _setup_gemini_cli_auth(self) -> None:
+    async def _setup_gemini_cli_auth(self) -> None:
         """Refresh and set the access token for Gemini CLI if configured."""
         from nanobot.config.loader import load_config
         config = load_config()
         cli_config = config.providers.google_gemini_cli
         
         if cli_config.refresh_token:
-            from nanobot.providers.gemini_cli_auth import refresh_access_token
+            from nanobot.providers.gemini_cli_auth import refresh_access_token_async
             try:
-                access_token, discovered_project = refresh_access_token(cli_config.refresh_token)
+                access_token, discovered_project = await refresh_access_token_async(cli_config.refresh_token)
                 os.environ["GOOGLE_CLOUD_ACCESS_TOKEN"] = access_token
                 
                 # Priority: 1. Config project_id, 2. Discovered project_id
@@ -147,7 +147,7 @@ class LiteLLMProvider(LLMProvider):
         
         if "gemini-cli" in model_name.lower():
             print("[DEBUG] Detected gemini-cli model, triggering auth setup...")
-            self._setup_gemini_cli_auth()
+            await self._setup_gemini_cli_auth()
 
         model = self._resolve_model(model_name)
         
@@ -0,0 +1,402 @@
+import json
+import threading
+from pathlib import Path
+
+import httpx
+import pytest
+
+from nanobot.providers import gemini_cli_auth as auth
+
+LOAD_URL = f"{auth.CODE_ASSIST_ENDPOINT}/v1internal:loadCodeAssist"
+ONBOARD_URL = f"{auth.CODE_ASSIST_ENDPOINT}/v1internal:onboardUser"
+LRO_URL = f"{auth.CODE_ASSIST_ENDPOINT}/v1internal/operations/onboard"
+
+
+class FakeGoogle:
+    """MockTransport handler with per-URL canned responses, recording every call."""
+
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, str]] = []
+        self.routes: dict[str, list] = {}
+
+    def on(self, url: str, *replies) -> None:
+        """Queue replies for a URL; the last one repeats. A reply may be an exception."""
+        self.routes[url] = list(replies)
+
+    def urls(self) -> list[str]:
+        return [url for _, url in self.calls]
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        self.calls.append((request.method, url))
+        replies = self.routes.get(url)
+        if not replies:
+            if url.endswith(":enable"):
+                return httpx.Response(200, json={"done": True})
+            return httpx.Response(404)
+        reply = replies.pop(0) if len(replies) > 1 else replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return httpx.Response(200, json=reply) if isinstance(reply, dict) else reply
+
+
+@pytest.fixture
+def google(monkeypatch, tmp_path):
+    fake = FakeGoogle()
+    fake.on(auth.TOKEN_URL, {"access_token": "tok", "expires_in": 3600})
+    transport = httpx.MockTransport(fake)
+    monkeypatch.setattr(auth, "_CLIENT", httpx.Client(transport=transport))
+    monkeypatch.setattr(auth, "_ASYNC_CLIENT", httpx.AsyncClient(transport=transport))
+    monkeypatch.setattr(auth, "ONBOARD_POLL_INITIAL_DELAY", 0.0)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.delenv("GOOGLE_CLOUD_PROJECT", raising=False)
+    monkeypatch.delenv("GOOGLE_CLOUD_PROJECT_ID", raising=False)
+    monkeypatch.delenv("NANOBOT_TRUST_ENV_PROJECT", raising=False)
+    auth.reset()
+    yield fake
+    auth.reset()
+
+
+def _onboarding(fake: FakeGoogle) -> None:
+    fake.on(LOAD_URL, {"allowedTiers": [{"id": "free-tier", "isDefault": True}]})
+    fake.on(ONBOARD_URL, {"name": "operations/onboard", "done": False})
+    fake.on(
+        LRO_URL,
+        {"name": "operations/onboard", "done": False},
+        {"name": "operations/onboard", "done": True,
+         "response": {"cloudaicompanionProject": {"id": "onboarded"}}},
+    )
+
+
+def test_token_cache_hit_skips_network(google):
+    google.on(LOAD_URL, {"currentTier": {"id": "standard"}, "cloudaicompanionProject": "proj"})
+
+    assert auth.refresh_access_token("rt") == ("tok", "proj")
+    calls = len(google.calls)
+    assert auth.refresh_access_token("rt") == ("tok", "proj")
+    assert len(google.calls) == calls
+
+
+def test_expired_token_is_refreshed_but_discovered_project_reused(google):
+    google.on(auth.TOKEN_URL, {"access_token": "tok", "expires_in": 30})
+    google.on(LOAD_URL, {"currentTier": {"id": "standard"}, "cloudaicompanionProject": "proj"})
+
+    auth.refresh_access_token("rt")
+    google.calls.clear()
+    assert auth.refresh_access_token("rt") == ("tok", "proj")
+    assert google.urls() == [auth.TOKEN_URL]
+
+
+def test_fallback_project_is_not_cached(google):
+    google.on(auth.TOKEN_URL, {"access_token": "tok", "expires_in": 30})
+    google.on(
+        LOAD_URL,
+        httpx.ConnectError("unreachable"),
+        {"currentTier": {"id": "standard"}, "cloudaicompanionProject": "realproj"},
+    )
+
+    assert auth.refresh_access_token("rt") == ("tok", auth.DEFAULT_PROJECT_ID)
+    assert auth.refresh_access_token("rt") == ("tok", "realproj")
+
+
+def test_poll_delays_back_off_exponentially_with_jitter(monkeypatch):
+    monkeypatch.setattr(auth, "ONBOARD_POLL_INITIAL_DELAY", 0.25)
+    monkeypatch.setattr(auth, "ONBOARD_POLL_MAX_DELAY", 5.0)
+
+    delays = auth._poll_delays()
+    for base in (0.25, 0.5, 1.0, 2.0, 4.0, 5.0, 5.0):
+        assert base <= next(delays) <= base * 1.25
+
+
+def test_onboarding_polls_before_first_sleep(google, monkeypatch):
+    _onboarding(google)
+    google.on(
+        LRO_URL,
+        {"name": "operations/onboard", "done": True,
+         "response": {"cloudaicompanionProject": {"id": "onboarded"}}},
+    )
+    sleeps = []
+    monkeypatch.setattr(auth.time, "sleep", sleeps.append)
+
+    assert auth.discover_project("tok") == "onboarded"
+    assert sleeps == []
+
+
+def test_trusted_env_project_skips_discovery(google, monkeypatch):
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "envproj")
+
+    assert auth.discover_project("tok") == "envproj"
+    assert google.calls == []
+
+
+def test_untrusted_env_project_still_runs_discovery(google, monkeypatch):
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "envproj")
+    monkeypatch.setenv("NANOBOT_TRUST_ENV_PROJECT", "0")
+    google.on(LOAD_URL, {"currentTier": {"id": "standard"}, "cloudaicompanionProject": "proj"})
+
+    assert auth.discover_project("tok") == "proj"
+    assert google.urls() == [LOAD_URL]
+
+
+def _install_gemini_cli(root: Path, bundle: bytes) -> Path:
+    package = root / "lib" / "node_modules" / "@google" / "gemini-cli"
+    executable = package / "bin" / "gemini"
+    executable.parent.mkdir(parents=True)
+    executable.touch()
+    oauth2 = (
+        package / "node_modules" / "@google" / "gemini-cli-core"
+        / "dist" / "src" / "code_assist" / "oauth2.js"
+    )
+    oauth2.parent.mkdir(parents=True)
+    oauth2.write_bytes(bundle)
+    return executable
+
+
+def test_extract_credentials_missing_cli_is_not_cached(google, monkeypatch, tmp_path):
+    monkeypatch.setattr(auth.shutil, "which", lambda name: None)
+    with pytest.raises(RuntimeError, match="not found in PATH"):
+        auth.extract_credentials()
+
+    executable = _install_gemini_cli(
+        tmp_path, b'"789-xyz.apps.googleusercontent.com" "GOCSPX-later"'
+    )
+    monkeypatch.setattr(auth.shutil, "which", lambda name: str(executable))
+    assert auth.extract_credentials() == ("789-xyz.apps.googleusercontent.com", "GOCSPX-later")
+
+
+@pytest.mark.parametrize("scenario", ["tier", "onboarding", "error"])
+async def test_sync_and_async_paths_match(google, scenario):
+    if scenario == "tier":
+        google.on(LOAD_URL, {"currentTier": {"id": "standard"}, "cloudaicompanionProject": "proj"})
+    elif scenario == "onboarding":
+        _onboarding(google)
+    else:
+        google.on(LOAD_URL, httpx.ConnectError("unreachable"))
+
+    sync_result = auth.refresh_access_token("rt")
+    sync_calls = list(google.calls)
+    auth._enabled_projects_path().unlink(missing_ok=True)
+    auth.reset()
+    google.calls.clear()
+    if scenario == "onboarding":
+        _onboarding(google)
+
+    assert await auth.refresh_access_token_async("rt") == sync_result
+    assert google.calls == sync_calls
+
+
+async def test_non_http_errors_fall_back_like_transport_errors(google, monkeypatch):
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "envproj")
+    monkeypatch.setenv("NANOBOT_TRUST_ENV_PROJECT", "0")
+    google.on(LOAD_URL, httpx.InvalidURL("bad url"))
+
+    assert auth.discover_project("tok") == "envproj"
+    assert await auth.discover_project_async("tok") == "envproj"
+
+
+def test_enabled_project_is_skipped_after_restart(google):
+    google.on(LOAD_URL, {"currentTier": {"id": "standard"}, "cloudaicompanionProject": "proj"})
+    enable_url = auth._vertex_enable_url("proj")
+
+    auth.refresh_access_token("rt")
+    assert enable_url in google.urls()
+    assert auth._enabled_projects_path().exists()
+
+    # reset() drops every in-memory cache, as a fresh process would
+    auth.reset()
+    google.calls.clear()
+    auth.refresh_access_token("rt")
+    assert LOAD_URL in google.urls()
+    assert enable_url not in google.urls()
+
+
+async def test_async_enable_keeps_file_io_off_the_event_loop(google, monkeypatch):
+    threads = []
+
+    def record(fn):
+        def wrapper(*args):
+            threads.append(threading.current_thread())
+            return fn(*args)
+        return wrapper
+
+    monkeypatch.setattr(auth, "_is_enabled", record(auth._is_enabled))
+    monkeypatch.setattr(auth, "_mark_enabled", record(auth._mark_enabled))
+
+    await auth.enable_vertex_api_async("proj", "tok")
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+
+
+@pytest.mark.parametrize(
+    "wait_reply",
+    [httpx.Response(404), httpx.Response(503), httpx.ReadTimeout("slow")],
+)
+def test_wait_failure_falls_back_to_polling(google, wait_reply):
+    _onboarding(google)
+    google.on(f"{LRO_URL}:wait", wait_reply)
+
+    assert auth.discover_project("tok") == "onboarded"
+    urls = google.urls()
+    assert urls.count(f"{LRO_URL}:wait") == 1
+    assert urls.count(LRO_URL) == 2
+
+
+def test_wait_completes_onboarding_without_polling(google):
+    _onboarding(google)
+    google.on(
+        f"{LRO_URL}:wait",
+        {"name": "operations/onboard", "done": True,
+         "response": {"cloudaicompanionProject": {"id": "waited"}}},
+    )
+
+    assert auth.discover_project("tok") == "waited"
+    assert LRO_URL not in google.urls()
+
+
+def test_enable_failure_keeps_discovered_project(google):
+    google.on(LOAD_URL, {"currentTier": {"id": "standard"}, "cloudaicompanionProject": "proj"})
+    google.on(auth._vertex_enable_url("proj"), httpx.Response(403))
+
+    assert auth.refresh_access_token("rt") == ("tok", "proj")
+    assert not auth._enabled_projects_path().exists()
+
+
+def test_stdlib_json_fallback_without_orjson(google, monkeypatch):
+    monkeypatch.setattr(auth, "ORJSON_AVAILABLE", False)
+    _onboarding(google)
+
+    body = {"tierId": "free-tier", "metadata": {"duetProject": None}}
+    assert json.loads(auth._json_body(body)) == body
+    assert auth._json(httpx.Response(200, json=body)) == body
+    assert auth.refresh_access_token("rt") == ("tok", "onboarded")
+
+
+def test_orjson_and_stdlib_encode_the_same_body(monkeypatch):
+    pytest.importorskip("orjson")
+    body = {"cloudaicompanionProject": "proj", "metadata": {"pluginType": "GEMINI"}}
+
+    monkeypatch.setattr(auth, "ORJSON_AVAILABLE", True)
+    fast = auth._json_body(body)
+    monkeypatch.setattr(auth, "ORJSON_AVAILABLE", False)
+    assert json.loads(fast) == json.loads(auth._json_body(body)) == body
+
+
+class FakeClock:
+    """Stands in for time.monotonic/time.sleep; only sleeps advance it."""
+
+    def __init__(self, monkeypatch) -> None:
+        self.now = 0.0
+        monkeypatch.setattr(auth.time, "monotonic", lambda: self.now)
+        monkeypatch.setattr(auth.time, "sleep", self.sleep)
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+def _timed_client(monkeypatch, google, clock, seen):
+    def handler(request):
+        seen.append((clock.now, request))
+        return google(request)
+
+    monkeypatch.setattr(auth, "_CLIENT", httpx.Client(transport=httpx.MockTransport(handler)))
+
+
+def test_poll_checks_lro_after_final_clamped_sleep(google, monkeypatch):
+    clock = FakeClock(monkeypatch)
+    seen = []
+    _timed_client(monkeypatch, google, clock, seen)
+    monkeypatch.setattr(auth, "ONBOARD_POLL_TIMEOUT", 1.0)
+    monkeypatch.setattr(auth, "ONBOARD_POLL_INITIAL_DELAY", 0.3)
+    monkeypatch.setattr(auth, "ONBOARD_POLL_MAX_DELAY", 0.3)
+    monkeypatch.setattr(auth.random, "uniform", lambda a, b: 0.0)
+    _onboarding(google)
+    pending = {"name": "operations/onboard", "done": False}
+    done = {"name": "operations/onboard", "done": True,
+            "response": {"cloudaicompanionProject": {"id": "onboarded"}}}
+    google.on(LRO_URL, pending, pending, pending, pending, done)
+
+    assert auth.discover_project("tok") == "onboarded"
+    polls = [t for t, r in seen if str(r.url) == LRO_URL]
+    assert polls[:4] == pytest.approx([0.0, 0.3, 0.6, 0.9])
+    assert polls[-1] == pytest.approx(1.0)
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_poll_gives_up_at_the_deadline(google, monkeypatch):
+    clock = FakeClock(monkeypatch)
+    monkeypatch.setattr(auth, "ONBOARD_POLL_TIMEOUT", 1.0)
+    monkeypatch.setattr(auth, "ONBOARD_POLL_INITIAL_DELAY", 0.3)
+    _onboarding(google)
+    google.on(LRO_URL, {"name": "operations/onboard", "done": False})
+
+    assert auth.discover_project("tok") is None
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_wait_is_clamped_to_the_deadline(google, monkeypatch):
+    seen = []
+    _timed_client(monkeypatch, google, FakeClock(monkeypatch), seen)
+    monkeypatch.setattr(auth, "ONBOARD_POLL_TIMEOUT", 12.0)
+    _onboarding(google)
+    google.on(
+        f"{LRO_URL}:wait",
+        {"name": "operations/onboard", "done": True,
+         "response": {"cloudaicompanionProject": {"id": "waited"}}},
+    )
+
+    assert auth.discover_project("tok") == "waited"
+    [wait] = [r for _, r in seen if str(r.url).endswith(":wait")]
+    assert json.loads(wait.content) == {"timeout": "12.000s"}
+    assert wait.extensions["timeout"]["read"] == pytest.approx(12.0)
+
+
+def test_extract_credentials_skips_candidate_under_a_file(google, monkeypatch, tmp_path):
+    scope = tmp_path / "node_modules" / "@google"
+    executable = scope / "gemini-cli" / "bin" / "gemini"
+    executable.parent.mkdir(parents=True)
+    executable.touch()
+    # The first candidate runs through a regular file; the second is real
+    (scope / "gemini-cli" / "node_modules").write_text("not a directory")
+    oauth2 = (
+        scope / "node_modules" / "@google" / "gemini-cli-core"
+        / "dist" / "src" / "code_assist" / "oauth2.js"
+    )
+    oauth2.parent.mkdir(parents=True)
+    oauth2.write_bytes(b'"123-abc.apps.googleusercontent.com" "GOCSPX-secret"')
+    monkeypatch.setattr(auth.shutil, "which", lambda name: str(executable))
+
+    assert auth.extract_credentials() == ("123-abc.apps.googleusercontent.com", "GOCSPX-secret")
+
+
+def test_extract_credentials_takes_first_of_each(google, monkeypatch, tmp_path):
+    bundle = (
+        b'const s = "GOCSPX-first_secret";'
+        b'const c = "123-abc.apps.googleusercontent.com";'
+        b'const s2 = "GOCSPX-second"; const c2 = "456-def.apps.googleusercontent.com";'
+    )
+    executable = _install_gemini_cli(tmp_path, bundle)
+    monkeypatch.setattr(auth.shutil, "which", lambda name: str(executable))
+
+    assert auth.extract_credentials() == ("123-abc.apps.googleusercontent.com", "GOCSPX-first_secret")
+
+
+def test_extract_credentials_without_match_raises(google, monkeypatch, tmp_path):
+    executable = _install_gemini_cli(tmp_path, b"no credentials here")
+    monkeypatch.setattr(auth.shutil, "which", lambda name: str(executable))
+
+    with pytest.raises(RuntimeError, match="Could not find Gemini CLI credentials"):
+        auth.extract_credentials()
+
+
+@pytest.mark.parametrize("tier", [{"id": "standard"}, {}])
+def test_current_tier_skips_onboarding(google, tier):
+    google.on(LOAD_URL, {"currentTier": tier})
+
+    assert auth.discover_project("tok") is None
+    assert ONBOARD_URL not in google.urls()
+
+
+def test_current_tier_accepts_project_object(google):
+    google.on(LOAD_URL, {"currentTier": {"id": "standard"}, "cloudaicompanionProject": {"id": "obj"}})
+
+    assert auth.discover_project("tok") == "obj"